@@ -1,4 +1,6 @@
 import datetime
+import glob
+import hashlib
 import json
 import os
 import sys
@@ -7,22 +9,32 @@ import pandas as pd
 
 import ostiapi
 
+from Scraper import DEFAULT_DOE_CONTRACT
+
 
 class Poster:
     """Use the form input and DSpace metadata to generate the JSON necessary
      for OSTI ingestion. Then post to OSTI using their API"""
     def __init__(
         self, mode, data_dir='data', to_upload='dataset_metadata_to_upload.json',
-        form_input_full_path='form_input.tsv', osti_upload='osti.json', response_dir="responses"
+        posted='dataset_metadata_posted.json',
+        form_input_full_path='form_input.tsv', osti_upload='osti.json', response_dir="responses",
+        research_org='PPPL', default_contract=DEFAULT_DOE_CONTRACT, credentials_prefix='OSTI'
     ):
         self.mode = mode
+        self.research_org = research_org
+        self.default_contract = default_contract
 
         # Prepare all paths
         self.form_input = form_input_full_path
         self.data_dir = data_dir
         self.to_upload = os.path.join(data_dir, to_upload)
+        self.posted = os.path.join(data_dir, posted)
         self.osti_upload = os.path.join(data_dir, osti_upload)
 
+        self.response_dir = response_dir
+        # Dry runs never store fingerprints, so they preview against prod
+        self.history_mode = 'prod' if mode == 'dry-run' else mode
         self.response_output = os.path.join(
             response_dir,
             f"{mode}_osti_response_{str(datetime.datetime.now()).replace(':', '')}.json"
@@ -33,11 +45,12 @@ class Poster:
 
         # Ensure minimum (test/prod) environment variables are prepared
         if mode in ['test', 'prod']:
-            environment_vars = [v + f'_{mode.upper()}' for
-                                v in ['OSTI_USERNAME', 'OSTI_PASSWORD']]
+            environment_vars = [f'{credentials_prefix}_{v}_{mode.upper()}' for
+                                v in ['USERNAME', 'PASSWORD']]
         if mode == 'dry-run':
-            environment_vars = ['OSTI_USERNAME_TEST', 'OSTI_PASSWORD_TEST',
-                                'OSTI_USERNAME_PROD', 'OSTI_PASSWORD_PROD']
+            environment_vars = [f'{credentials_prefix}_{v}' for
+                                v in ['USERNAME_TEST', 'PASSWORD_TEST',
+                                      'USERNAME_PROD', 'PASSWORD_PROD']]
 
         assert all([var in os.environ for var in environment_vars]), \
             f'All {mode} environment variables need to be set. ' \
@@ -45,8 +58,8 @@ class Poster:
 
         # Assign username and password depending on where data is being posted
         if mode in ['test', 'prod']:
-            self.username = os.environ[f'OSTI_USERNAME_{mode.upper()}']
-            self.password = os.environ[f'OSTI_PASSWORD_{mode.upper()}']
+            self.username = os.environ[f'{credentials_prefix}_USERNAME_{mode.upper()}']
+            self.password = os.environ[f'{credentials_prefix}_PASSWORD_{mode.upper()}']
         else:
             self.username, self.password = None, None
 
@@ -85,66 +98,117 @@ class Poster:
             dspace_data = [item for item in to_upload_j if item['id'] == dspace_id]
             assert len(dspace_data) == 1, dspace_data
             dspace_data = dspace_data[0]
-            
-            # get publication date
-            date_info = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.date.available']
-            assert len(date_info) == 1
-            date_info = date_info[0]
-            pub_dt = datetime.datetime.strptime(date_info, "%Y-%m-%dT%H:%M:%S%z")
-            pub_date = pub_dt.strftime('%m/%d/%Y')
-
-            # Collect all required information
-            item_dict = {
-                'title': dspace_data['name'],
-                'creators': ';'.join(
-                    [
-                        m['value']
-                        for m in dspace_data['metadata']
-                        if m['key'] == 'dc.contributor.author'
-                    ]
-                ),
-                'dataset_type': row['Datatype'],
-                'site_url': "https://arks.princeton.edu/ark:/" + dspace_data['handle'],
-                'contract_nos': row['DOE Contract'],
-                'sponsor_org': row['Sponsoring Organizations'],
-                'research_org': 'PPPL',
-                'accession_num': dspace_data['handle'],
-                'publication_date': pub_date,
-                'othnondoe_contract_nos': row['Non-DOE Contract'],
-            }
-
-            # Collect optional required information
-            abstract = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.description.abstract']
-            if len(abstract) != 0:
-                item_dict['description'] = '\n\n'.join(abstract)
-
-            keywords = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.subject']
-            if len(keywords) != 0:
-                item_dict['keywords'] = '; '.join(keywords)
-
-            is_referenced_by = [m['value'] for m in dspace_data['metadata'] if
-                                m['key'] == 'dc.relation.isreferencedby']
-            if len(is_referenced_by) != 0:
-                item_dict['related_identifiers'] = []
-                for irb in is_referenced_by:
-                    item_dict['related_identifiers'].append({
-                        'related_identifier': irb.split('doi.org/')[1],
-                        'relation_type': 'IsReferencedBy',
-                        'related_identifier_type': 'DOI',
-                    })
-
-            osti_format.append(item_dict)
+
+            osti_format.append(self._dspace_to_osti(
+                dspace_data, row['Datatype'], row['DOE Contract'],
+                row['Sponsoring Organizations'], row['Non-DOE Contract']
+            ))
+
+        osti_format.extend(self.generate_posted_records())
 
         with open(self.osti_upload, 'w') as f:
             json.dump(osti_format, f, indent=4)
 
+    def _dspace_to_osti(self, dspace_data, dataset_type, contract_nos,
+                        sponsor_org, othnondoe_contract_nos):
+        """Combine DSpace metadata with the information OSTI requires that
+         DSpace does not have"""
+        # get publication date
+        date_info = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.date.available']
+        assert len(date_info) == 1
+        date_info = date_info[0]
+        pub_dt = datetime.datetime.strptime(date_info, "%Y-%m-%dT%H:%M:%S%z")
+        pub_date = pub_dt.strftime('%m/%d/%Y')
+
+        # Collect all required information
+        item_dict = {
+            'title': dspace_data['name'],
+            'creators': ';'.join(
+                [
+                    m['value']
+                    for m in dspace_data['metadata']
+                    if m['key'] == 'dc.contributor.author'
+                ]
+            ),
+            'dataset_type': dataset_type,
+            'site_url': "https://arks.princeton.edu/ark:/" + dspace_data['handle'],
+            'contract_nos': contract_nos,
+            'sponsor_org': sponsor_org,
+            'research_org': self.research_org,
+            'accession_num': dspace_data['handle'],
+            'publication_date': pub_date,
+            'othnondoe_contract_nos': othnondoe_contract_nos,
+        }
+
+        # Collect optional required information
+        abstract = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.description.abstract']
+        if len(abstract) != 0:
+            item_dict['description'] = '\n\n'.join(abstract)
+
+        keywords = [m['value'] for m in dspace_data['metadata'] if m['key'] == 'dc.subject']
+        if len(keywords) != 0:
+            item_dict['keywords'] = '; '.join(keywords)
+
+        is_referenced_by = [m['value'] for m in dspace_data['metadata'] if
+                            m['key'] == 'dc.relation.isreferencedby']
+        if len(is_referenced_by) != 0:
+            item_dict['related_identifiers'] = []
+            for irb in is_referenced_by:
+                item_dict['related_identifiers'].append({
+                    'related_identifier': irb.split('doi.org/')[1],
+                    'relation_type': 'IsReferencedBy',
+                    'related_identifier_type': 'DOI',
+                })
+
+        return item_dict
+
+    def generate_posted_records(self):
+        """Regenerate the OSTI metadata of records that are already in OSTI,
+         so that changes to them can be detected. Whatever was entered in the
+         form is taken from their last successful response, falling back on
+         OSTI's own metadata. Only the Datatype has no fallback"""
+        if not os.path.exists(self.posted):
+            return []
+
+        with open(self.posted) as f:
+            posted_j = json.load(f)
+
+        posted = self.get_posted_records()
+        records, unchecked = [], []
+        for dspace_data in posted_j:
+            previous = posted.get(dspace_data['handle'], {})
+            if not previous.get('dataset_type'):
+                unchecked.append(dspace_data)
+                continue
+
+            osti_data = dspace_data.get('osti', {})
+            contract_nos = previous.get('contract_nos') or \
+                osti_data.get('doe_contract_number') or self.default_contract
+            sponsor_org = previous.get('sponsor_org') or \
+                '; '.join(osti_data.get('sponsor_orgs') or [])
+            othnondoe_contract_nos = previous.get('othnondoe_contract_nos') or ''
+
+            records.append(self._dspace_to_osti(
+                dspace_data, previous['dataset_type'], contract_nos,
+                sponsor_org, othnondoe_contract_nos
+            ))
+
+        print(f"{len(records)} of {len(posted_j)} records already in OSTI have a "
+              f"{self.history_mode} response to check them for changes against.")
+        if len(unchecked) > 0:
+            print("The following records have no Datatype in a previous response, "
+                  "so changes to them cannot be detected:")
+            for dspace_data in unchecked:
+                print(f"\t{dspace_data['handle']} {repr(dspace_data['name'])}")
+        return records
+
     @staticmethod
     def _fake_post(records):
         """A fake JSON response that mirrors OSTI's"""
         return {
             "record": [
                 {
-                    "osti_id": "1488485",
+                    "osti_id": record.get("osti_id", "1488485"),
                     "accession_num": record["accession_num"],
                     "product_nos": "None",
                     "title": record["title"],
@@ -160,24 +224,105 @@ class Poster:
             ]
         }
 
+    @staticmethod
+    def fingerprint(record):
+        """A canonical SHA-256 digest of a record's OSTI metadata, used to
+         detect whether it changed since it was last posted"""
+        canonical = json.dumps(record, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_posted_records(self):
+        """Collect what is known about each accession number from the
+         successful responses and fingerprint baselines of previous runs.
+         Dry runs are checked against prod's responses"""
+        posted = {}
+        pattern = os.path.join(self.response_dir, f"{self.history_mode}_osti_response_*.json")
+        for response_file in sorted(glob.glob(pattern)):
+            with open(response_file) as f:
+                response_j = json.load(f)
+            items = [item for item in response_j['record'] if item['status'] == 'SUCCESS']
+            items.extend(response_j.get('baseline', []))
+            for item in items:
+                if item.get('accession_num'):
+                    accession_num = item['accession_num']
+                    posted[accession_num] = dict(posted.get(accession_num, {}), **item)
+        return posted
+
+    def get_changed_records(self, osti_j):
+        """Split records into those that are new or changed since their last
+         successful post, and those posted before fingerprints were stored.
+         Changed records are sent with their osti_id so that they are posted
+         as updates"""
+        posted = self.get_posted_records()
+
+        changed, fingerprints, baseline = [], {}, []
+        for record in osti_j:
+            fingerprint = self.fingerprint(record)
+            previous = posted.get(record['accession_num'])
+            if previous is None:
+                fingerprints[record['accession_num']] = fingerprint
+                changed.append(record)
+            elif 'fingerprint' not in previous:
+                # Unknown whether it changed: record a baseline instead of resending it
+                baseline.append({
+                    'accession_num': record['accession_num'],
+                    'osti_id': previous['osti_id'],
+                    'fingerprint': fingerprint,
+                })
+            elif previous['fingerprint'] != fingerprint:
+                fingerprints[record['accession_num']] = fingerprint
+                changed.append(dict(record, osti_id=previous['osti_id']))
+
+        return changed, fingerprints, baseline
+
     def post_to_osti(self):
-        """Post the collected metadata to OSTI's test or prod server. If in
-         dry-run mode, call our _fake_post method"""
+        """Post the new or changed metadata to OSTI's test or prod server.
+         If in dry-run mode, call our _fake_post method with every record"""
         if self.mode == 'test':
             ostiapi.testmode()
 
         with open(self.osti_upload) as f:
             osti_j = json.load(f)
 
-        print('Posting data...')
+        changed, fingerprints, baseline = self.get_changed_records(osti_j)
         if self.mode == 'dry-run':
-            response_data = self._fake_post(osti_j)
+            print(f"A prod post would send {len(changed)} of {len(osti_j)} records "
+                  f"and record a fingerprint baseline for {len(baseline)}.")
+            response_data = {'record': []}
         else:
-            response_data = ostiapi.post(osti_j, self.username, self.password)
+            print(f"Skipping {len(osti_j) - len(changed)} unchanged records.")
+            osti_j = changed
+            response_data = {'record': [], 'baseline': baseline}
+            if len(baseline) != 0:
+                print(f"Recording a fingerprint baseline for {len(baseline)} records "
+                      "posted before fingerprints were stored. They are not resent.")
+
+        if len(osti_j) == 0:
+            print("Nothing to post. All records match their last upload.")
+        else:
+            print('Posting data...')
+            if self.mode == 'dry-run':
+                response_data = self._fake_post(osti_j)
+            else:
+                response_data = dict(
+                    response_data, **ostiapi.post(osti_j, self.username, self.password)
+                )
+
+        # Store fingerprints with successful responses for the next run
+        if self.mode != 'dry-run':
+            for item in response_data['record']:
+                if item['status'] == 'SUCCESS':
+                    item['fingerprint'] = fingerprints.get(item['accession_num'])
+
+        if len(response_data['record']) == 0 and not response_data.get('baseline'):
+            return
 
         with open(self.response_output, 'w') as f:
             json.dump(response_data, f, indent=4)
-        
+
+        if len(response_data['record']) == 0:
+            return
+
         # output results to the shell:
         for item in response_data['record']:
             if item['status'] == 'SUCCESS':
@@ -35,6 +35,10 @@ PPPL_COLLECTIONS = {
 
 PPPL_COMMUNITY_ID = 346
 
+# PPPL's prime contract, used when DOE funding has no grant number
+DEFAULT_DOE_CONTRACT = "AC02-09CH11466"
+DEFAULT_SPONSOR_ORG = "USDOE Office of Science (SC)"
+
 # All possible prefix
 REGEX_DOE = r"^(DE|AC|SC|FC|FG|AR|EE|EM|FE|NA|NE)"  # https://regex101.com/r/SxNHJg
 REGEX_DOE_SUB = "^(DE)+(-?)"  # https://regex101.com/r/NsZbRJ
@@ -87,28 +91,62 @@ class Scraper:
     :param form_input_full_path: TSV file containing DataSpace
            records and DOE metadata for submission
     :param to_upload: JSON output file containing metadata for OSTI upload
+    :param posted: JSON output file containing metadata of records already
+           in OSTI
     :param redirects: JSON output file containing DOI redirects
+    :param site_code: OSTI site ownership code of the records to compare
+    :param community_id: DataSpace community ID whose items are collected
+    :param collections: DataSpace collection names and IDs in the community
+    :param session: HTTP session reused for all requests. Defaults to a
+           legacy session (see #73)
+    :param redirects_cache: Mapping of DOI redirects shared with other
+           scrapers. When given, ``redirects`` is neither read nor written
+    :param default_contract: DOE contract used for records without a grant
+           number
+    :param sponsor_org: Sponsoring organization pre-filled in the entry form
+    :param other_handles: Handles of DataSpace items in other communities
+           of the same OSTI site. Their OSTI records are ignored
 
     :ivar osti_scrape: JSON output file containing OSTI metadata
     :ivar dspace_scrape: JSON output file containing DataSpace metadata
     :ivar entry_form: TSV file containing DataSpace records not in OSTI
     :ivar to_upload: JSON output file containing metadata for OSTI upload
+    :ivar posted: JSON output file containing metadata of records already
+          in OSTI
     :ivar redirects: JSON output file containing DOI redirects
+    :ivar report: Record counts and mismatched titles collected while
+          running the pipeline
     """
     def __init__(self, data_dir='data', osti_scrape='osti_scrape.json',
                  dspace_scrape='dspace_scrape.json',
                  entry_form_full_path='entry_form.tsv',
                  form_input_full_path='form_input.tsv',
                  to_upload='dataset_metadata_to_upload.json',
-                 redirects='redirects.json'):
+                 posted='dataset_metadata_posted.json',
+                 redirects='redirects.json', site_code='PPPL',
+                 community_id=PPPL_COMMUNITY_ID, collections=None,
+                 session=None, redirects_cache=None,
+                 default_contract=DEFAULT_DOE_CONTRACT,
+                 sponsor_org=DEFAULT_SPONSOR_ORG, other_handles=None):
 
         self.osti_scrape = pjoin(data_dir, osti_scrape)
         self.dspace_scrape = pjoin(data_dir, dspace_scrape)
         self.entry_form = entry_form_full_path
         self.form_input = form_input_full_path
         self.to_upload = pjoin(data_dir, to_upload)
+        self.posted = pjoin(data_dir, posted)
         self.redirects = pjoin(data_dir, redirects)
 
+        self.site_code = site_code
+        self.community_id = community_id
+        self.collections = PPPL_COLLECTIONS if collections is None else collections
+        self.session = get_legacy_session() if session is None else session  # fix for #73
+        self.redirects_cache = redirects_cache
+        self.default_contract = default_contract
+        self.sponsor_org = sponsor_org
+        self.other_handles = set() if other_handles is None else set(other_handles)
+        self.report = {'site_code': site_code, 'community_id': community_id}
+
         if not os.path.exists(data_dir):
             os.mkdir(data_dir)
 
@@ -121,47 +159,52 @@ class Scraper:
         existing_datasets = []
 
         for page in range(MAX_PAGE_COUNT):
-            url = f"https://www.osti.gov/dataexplorer/api/v1/records?site_ownership_code=PPPL&page={page}"
-            r = get_legacy_session().get(url)  # fix for #73
+            url = (f"https://www.osti.gov/dataexplorer/api/v1/records?"
+                   f"site_ownership_code={self.site_code}&page={page}")
+            r = self.session.get(url)
             j = json.loads(r.text)
             if len(j) != 0:
                 existing_datasets.extend(j)
             else:
                 print(f'Pulled {len(existing_datasets)} records from OSTI.')
+                self.report['osti'] = len(existing_datasets)
                 break
         else:
-            raise BaseException("Didn't reach the final page of OSTI! Increase the variable MAX_PAGE_COUNT")
+            raise RuntimeError("Didn't reach the final page of OSTI! Increase the variable MAX_PAGE_COUNT")
 
         with open(self.osti_scrape, 'w') as f:
             json.dump(existing_datasets, f, indent=4)
 
     def get_dspace_metadata(self):
         """
-        Collect metadata on all items from all DataSpace PPPL collections
+        Collect metadata on all items from all collections in the DataSpace
+        community
 
         """
 
         all_items = []
 
-        for c_name, c_id in PPPL_COLLECTIONS.items():
+        for c_name, c_id in self.collections.items():
             url = f'https://dataspace.princeton.edu/rest/collections/{c_id}/items?expand=metadata'
-            r = requests.get(url)
+            r = self.session.get(url)
             j = json.loads(r.text)
             all_items.extend(j)
 
         # Confirm that all collections were included
-        url_all = f"https://dataspace.princeton.edu/rest/communities/{PPPL_COMMUNITY_ID}"
-        r = requests.get(url_all)
+        url_all = f"https://dataspace.princeton.edu/rest/communities/{self.community_id}"
+        r = self.session.get(url_all)
         print('countItems: ', json.loads(r.text)['countItems'])
         print('all_items: ', len(all_items))
         assert json.loads(r.text)['countItems'] == len(all_items),\
-            ("The number of items in the PPPL community does not equal the "
-             "number of items collected. Review the list of collections we "
-             "search through (variable COLLECTION_IDS) and ensure that all "
-             "PPPL collections are included. Or write a recursive function "
-             "to prevent this from happening again.")
+            (f"The number of items in community {self.community_id} does not "
+             "equal the number of items collected. Review the list of "
+             "collections we search through (variable PPPL_COLLECTIONS or the "
+             "shard configuration) and ensure that all of the community's "
+             "collections are included. Or write a recursive function to "
+             "prevent this from happening again.")
 
         print(f'Pulled {len(all_items)} records from DSpace.')
+        self.report['dspace'] = len(all_items)
         with open(self.dspace_scrape, 'w') as f:
             json.dump(all_items, f, indent=4)
 
@@ -169,7 +212,7 @@ class Scraper:
         """Compare OSTI and DataSpace JSON to identify records to be uploaded"""
         def get_handle(doi, redirects_j):
             if doi not in redirects_j:
-                r = get_legacy_session().get(doi)  # fix for #73
+                r = self.session.get(doi)
                 assert r.status_code == 200, f"Error parsing DOI: {doi}"
                 handle = r.url.split('handle/')[-1]
                 redirects_j[doi] = handle
@@ -177,8 +220,13 @@ class Scraper:
             else:
                 return redirects_j[doi]
 
-        with open(self.redirects) as f:
-            redirects_j = json.load(f)
+        if self.redirects_cache is None:
+            with open(self.redirects) as f:
+                redirects_j = json.load(f)
+        else:
+            # Look up locally and share only the new DOIs, in one round trip
+            redirects_j = self.redirects_cache.copy()
+        known_dois = set(redirects_j)
         with open(self.dspace_scrape) as f:
             dspace_j = json.load(f)
         with open(self.osti_scrape) as f:
@@ -189,19 +237,47 @@ class Scraper:
         osti_handles = [get_handle(record['doi'], redirects_j)
                         for record in osti_j]
 
+        # Only keep the OSTI records of this community
+        if len(self.other_handles) > 0:
+            osti_j = [record for record, handle in zip(osti_j, osti_handles)
+                      if handle not in self.other_handles]
+            osti_handles = [handle for handle in osti_handles
+                            if handle not in self.other_handles]
+        self.report['osti'] = len(osti_j)
+
+        osti_by_handle = dict(zip(osti_handles, osti_j))
+
         to_be_published = []
+        already_posted = []
         for dspace_record in dspace_j:
-            if dspace_record['handle'] not in osti_handles:
+            if dspace_record['handle'] not in osti_by_handle:
                 to_be_published.append(dspace_record)
+            else:
+                # OSTI's copy of what was entered in the form when it was posted
+                osti_record = osti_by_handle[dspace_record['handle']]
+                already_posted.append(dict(dspace_record, osti={
+                    key: osti_record.get(key)
+                    for key in ['osti_id', 'sponsor_orgs', 'doe_contract_number']
+                }))
 
         with open(self.to_upload, 'w') as f:
             json.dump(to_be_published, f, indent=4)
-        with open(self.redirects, 'w') as f:
-            json.dump(redirects_j, f, indent=4)
+        # Kept so that Poster can detect changes to records already in OSTI
+        with open(self.posted, 'w') as f:
+            json.dump(already_posted, f, indent=4)
+        if self.redirects_cache is None:
+            with open(self.redirects, 'w') as f:
+                json.dump(redirects_j, f, indent=4)
+        else:
+            self.redirects_cache.update(
+                {doi: handle for doi, handle in redirects_j.items() if doi not in known_dois}
+            )
+        self.report['unposted'] = len(to_be_published)
 
         # Check for records in OSTI but not DSpace
         dspace_handles = [record['handle'] for record in dspace_j]
         errors = [record for record in osti_j if redirects_j[record['doi']] not in dspace_handles]
+        self.report['osti_not_dspace'] = [error['title'] for error in errors]
         if len(errors) > 0:
             print(f"The following records were found on OSTI but not in DSpace (that" + 
                   " shouldn't happen). If they closely resemble records we are about to" +
@@ -229,43 +305,20 @@ class Scraper:
                                 for item in to_upload_j]
 
         # Retrieve funding data
-        funding_text_list = [
-            [
-                m['value']
-                for m in item['metadata']
-                if m['key'] == 'dc.contributor.funder'
-            ]
-            for item in to_upload_j
-        ]
-
-        # Generate lists of lists per each dc.contributor.funder entry
-        funding_result = [
-            list(filter(None, map(get_funder, f_list)))
-            for f_list in funding_text_list
-        ]
-        funding_result_simple = [  # All grants for each DSpace record
-            ";".join([";".join(value) if value else "" for value in res])
-            for res in funding_result
-        ]
-        funding_source_dict = list(map(get_doe_funding, funding_result_simple))
-
-        df['DOE Contract'] = [
-            ";".join(sorted(d.get("doe"))) for d in funding_source_dict
-        ]
-        df['Non-DOE Contract'] = [
-            ";".join(sorted(d.get("other"))) for d in funding_source_dict
-        ]
-
-        # Sponsoring organizations is always Office of Science
-        df['Sponsoring Organizations'] = "USDOE Office of Science (SC)"
+        contracts = [get_contracts(item, self.default_contract) for item in to_upload_j]
+        df['DOE Contract'] = [c['doe'] for c in contracts]
+        df['Non-DOE Contract'] = [c['other'] for c in contracts]
+
+        # Sponsoring organizations is always the same for a site
+        df['Sponsoring Organizations'] = self.sponsor_org
 
         df['Datatype'] = None  # To be filled in
 
         df = df.sort_values('Issue Date')
         df.to_csv(self.entry_form, index=False, sep='\t')
 
-        print(f"{df.shape[0]} unpublished records were found in the PPPL "
-              f"dataspace community that have not been registered with OSTI.")
+        print(f"{df.shape[0]} unpublished records were found in dataspace "
+              f"community {self.community_id} that have not been registered with OSTI.")
         print(f"They've been saved to the form {self.entry_form}.")
         print("You're now expected to manually update that form and save as a "
               "new file before running Poster.py")
@@ -273,14 +326,27 @@ class Scraper:
             print(f"\t{repr(row['Title'])}")
             print(f"\t\t{row['Dataspace Link']}")
 
-    def update_form_input(self):
+    def update_form_input(self, create=False):
         """
         Update form_input.tsv by adding new records or removing DataSpace
         records that were removed/withdrawn
 
         In most cases, this will update form_input.tsv. This further supports CI
+
+        :param create: Create form_input.tsv from the entry form if it does
+               not exist yet, instead of raising FileNotFoundError
         """
-        if os.path.exists(self.form_input):
+        if not os.path.exists(self.form_input) and create:
+            print(f"File does not exist. Will create: {self.form_input}")
+
+            entry_df = pd.read_csv(self.entry_form, index_col=DSPACE_ID, sep='\t')
+
+            # "AS" is a placeholder - not included in DataSpace metadata
+            entry_df['Datatype'] = "AS"
+
+            entry_df.to_csv(self.form_input, sep='\t')
+            self.report['form_input_created'] = True
+        elif os.path.exists(self.form_input):
             print(f"File exists. Will update: {self.form_input}")
 
             entry_df = pd.read_csv(self.entry_form, index_col=DSPACE_ID, sep='\t')
@@ -301,21 +367,23 @@ class Scraper:
 
             # "AS" is a placeholder - not included in DataSpace metadata
             revised_df.loc[adds, 'Datatype'] = "AS"
+            self.report['form_input_added'] = len(adds)
 
             revised_df.to_csv(self.form_input, sep='\t')
         else:
             raise FileNotFoundError(f"WARNING: {self.form_input} does not exist!")
 
-    def run_pipeline(self, scrape=True):
+    def run_pipeline(self, scrape=True, create_form_input=False):
         if scrape:
             self.get_existing_datasets()
             self.get_dspace_metadata()
         self.get_unposted_metadata()
         self.generate_contract_entry_form()
-        self.update_form_input()
+        self.update_form_input(create=create_form_input)
+        return self.report
 
 
-def get_funder(text: str) -> list:
+def get_funder(text: str, default_contract: str = DEFAULT_DOE_CONTRACT) -> list:
     """Aggregate funding grant numbers from text"""
 
     # Clean up text by fixing any whitespace to get full grant no.
@@ -327,13 +395,13 @@ def get_funder(text: str) -> list:
 
     base_match = re.match(REGEX_BARE_DOE, text)
     if base_match:  # DOE/FES funded but no grant number
-        return ["AC02-09CH11466"]
+        return [default_contract]
     else:
         matches = re.finditer(REGEX_FUNDING, text)
         return [m.group() for m in matches]
 
 
-def get_doe_funding(grant_nos: str) -> Dict[str, set]:
+def get_doe_funding(grant_nos: str, default_contract: str = DEFAULT_DOE_CONTRACT) -> Dict[str, set]:
     """Separate DOE from other funding. Prefix DE prefix"""
 
     grant_dict = {
@@ -342,7 +410,7 @@ def get_doe_funding(grant_nos: str) -> Dict[str, set]:
     }
 
     if not grant_nos:  # Empty case
-        grant_dict["doe"].update(["AC02-09CH11466"])
+        grant_dict["doe"].update([default_contract])
     else:
         grants = grant_nos.split(";")
         for grant in grants:
@@ -354,6 +422,27 @@ def get_doe_funding(grant_nos: str) -> Dict[str, set]:
     return grant_dict
 
 
+def get_contracts(item: dict, default_contract: str = DEFAULT_DOE_CONTRACT) -> Dict[str, str]:
+    """DOE and non-DOE contract numbers of a DataSpace item, as they are
+    pre-filled in the entry form"""
+
+    funding_text = [
+        m['value']
+        for m in item['metadata']
+        if m['key'] == 'dc.contributor.funder'
+    ]
+
+    # Generate lists per each dc.contributor.funder entry
+    funding_result = list(filter(None, [get_funder(text, default_contract) for text in funding_text]))
+    grant_nos = ";".join([";".join(value) for value in funding_result])
+    funding_source = get_doe_funding(grant_nos, default_contract)
+
+    return {
+        "doe": ";".join(sorted(funding_source["doe"])),
+        "other": ";".join(sorted(funding_source["other"])),
+    }
+
+
 # Fix for OpenSSL issue: https://github.com/pulibrary/dspace-osti/issues/73
 def get_legacy_session():
     ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
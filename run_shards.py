@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+Run the scrape-reconcile-post pipeline for several DataSpace communities or
+OSTI site codes in one invocation. Each shard runs in its own worker process;
+every OSTI site is scraped once for all of its shards, the shards share one
+DOI redirect cache and their reports are merged at the end.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+
+from os.path import join as pjoin
+
+from Poster import Poster
+from Scraper import (DEFAULT_DOE_CONTRACT, DEFAULT_SPONSOR_ORG, Scraper,
+                     get_legacy_session)
+
+# Only PPPL shards may leave these out; other sites must set their own
+PPPL_SETTINGS = {
+    'research_org': 'PPPL',
+    'default_contract': DEFAULT_DOE_CONTRACT,
+    'sponsor_org': DEFAULT_SPONSOR_ORG,
+    'credentials_prefix': 'OSTI',
+}
+
+# HTTP session reused by every shard that runs in a worker process
+_session = None
+
+
+def _init_worker():
+    global _session
+    _session = get_legacy_session()  # fix for #73
+
+
+def get_shard_settings(shard, shard_dir):
+    """
+    Fill in PPPL's settings for PPPL shards, and make sure every other
+    shard sets its own. A shard's files go in its own subfolder of
+    shard_dir, except form_input and response_dir if the shard sets them
+    """
+    required = ['name', 'site_code', 'community_id', 'collections']
+    missing = [key for key in required if key not in shard]
+    assert not missing, f"Shard {shard.get('name')} is missing {missing}"
+
+    if shard['site_code'] == 'PPPL':
+        shard = dict(PPPL_SETTINGS, **shard)
+
+    missing = [key for key in PPPL_SETTINGS if key not in shard]
+    assert not missing, \
+        f"Shard {shard['name']} is not a PPPL shard and must set {missing}"
+
+    folder = pjoin(shard_dir, shard['name'])
+    return dict({
+        'data_dir': pjoin(folder, 'data'),
+        'entry_form': pjoin(folder, 'entry_form.tsv'),
+        'form_input': pjoin(folder, 'form_input.tsv'),
+        'response_dir': pjoin(folder, 'responses'),
+    }, **shard)
+
+
+def get_scraper(shard, **kwargs):
+    """A Scraper writing to the shard's files"""
+    os.makedirs(shard['data_dir'], exist_ok=True)
+    return Scraper(
+        data_dir=shard['data_dir'], entry_form_full_path=shard['entry_form'],
+        form_input_full_path=shard['form_input'], site_code=shard['site_code'],
+        community_id=shard['community_id'], collections=shard['collections'],
+        default_contract=shard['default_contract'],
+        sponsor_org=shard['sponsor_org'], session=_session, **kwargs
+    )
+
+
+def scrape_site(site_shards):
+    """Pull an OSTI site's records once and save them for each of its shards"""
+    report = {}
+    try:
+        s = get_scraper(site_shards[0])
+        s.get_existing_datasets()
+        report['osti'] = s.report['osti']
+        for shard in site_shards[1:]:
+            os.makedirs(shard['data_dir'], exist_ok=True)
+            shutil.copy(s.osti_scrape, pjoin(shard['data_dir'], os.path.basename(s.osti_scrape)))
+    except Exception as e:
+        report['error'] = repr(e)
+    return report
+
+
+def scrape_dspace(shard):
+    """Pull the metadata of a shard's DataSpace community"""
+    report = {}
+    try:
+        s = get_scraper(shard)
+        s.get_dspace_metadata()
+        with open(s.dspace_scrape) as f:
+            report['handles'] = [item['handle'] for item in json.load(f)]
+        report['dspace'] = s.report['dspace']
+    except Exception as e:
+        report['error'] = repr(e)
+    return report
+
+
+def run_shard(shard, mode, redirects_cache, other_handles):
+    """
+    Reconcile a shard's scraped OSTI and DataSpace records and, if a mode is
+    given, post its records to OSTI. A shard whose form input gained
+    unreviewed rows is not posted to OSTI's test or prod server
+
+    :param shard: Shard configuration (see get_shard_settings)
+    :param mode: Poster mode (dry-run/test/prod), or None to skip posting
+    :param redirects_cache: DOI redirects shared between all shards
+    :param other_handles: Handles of the other shards of the same OSTI site
+    :return: The shard's report
+    """
+    report = {}
+    try:
+        s = get_scraper(
+            shard, redirects_cache=redirects_cache, other_handles=other_handles
+        )
+        report = s.report
+        s.run_pipeline(scrape=False, create_form_input=True)
+
+        if mode in ['test', 'prod'] and \
+                (report.get('form_input_created') or report.get('form_input_added')):
+            raise RuntimeError(
+                f"{shard['form_input']} has new rows with the placeholder "
+                f"Datatype AS. Review it and run again to post to {mode}."
+            )
+        if mode is not None:
+            os.makedirs(shard['response_dir'], exist_ok=True)
+            p = Poster(
+                mode, data_dir=shard['data_dir'],
+                form_input_full_path=shard['form_input'],
+                response_dir=shard['response_dir'],
+                research_org=shard['research_org'],
+                default_contract=shard['default_contract'],
+                credentials_prefix=shard['credentials_prefix'],
+            )
+            p.run_pipeline()
+    except Exception as e:
+        report['error'] = repr(e)
+    return report
+
+
+def merge_reports(reports, site_reports):
+    """Combine the shards' reports into totals across all shards. OSTI
+    records are counted once per site"""
+    merged = {
+        'shards': reports,
+        'sites': site_reports,
+        'failed': [r['name'] for r in reports if 'error' in r],
+        'osti': sum(r.get('osti', 0) for r in site_reports.values()),
+    }
+    for key in ['dspace', 'unposted']:
+        merged[key] = sum(r.get(key, 0) for r in reports)
+    return merged
+
+
+def run_shards(config_path, shard_dir='shards', redirects='data/redirects.json',
+               mode=None, processes=None):
+    """
+    Run every shard listed in the JSON configuration in a pool of worker
+    processes, then save the shared redirects and the merged report
+    """
+    with open(config_path) as f:
+        shards = json.load(f)
+    with open(redirects) as f:
+        redirects_j = json.load(f)
+
+    assert len(shards) != 0, f"{config_path} does not list any shards"
+    shards = [get_shard_settings(shard, shard_dir) for shard in shards]
+
+    names = [shard['name'] for shard in shards]
+    assert len(names) == len(set(names)), \
+        f"Shard names must be unique: {names}"
+
+    sites = {}
+    for shard in shards:
+        sites.setdefault(shard['site_code'], []).append(shard)
+
+    if processes is None:
+        processes = min(len(shards), os.cpu_count() or 1)
+
+    with multiprocessing.Manager() as manager:
+        redirects_cache = manager.dict(redirects_j)
+        with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+            # Scrape each OSTI site once, and each community
+            site_results = {site_code: pool.apply_async(scrape_site, (site_shards,))
+                            for site_code, site_shards in sites.items()}
+            dspace_results = [pool.apply_async(scrape_dspace, (shard,)) for shard in shards]
+            site_reports = {site_code: r.get() for site_code, r in site_results.items()}
+            dspace_reports = {shard['name']: r.get() for shard, r in zip(shards, dspace_results)}
+
+            shard_results = []
+            for shard in shards:
+                error = site_reports[shard['site_code']].get('error') or \
+                    dspace_reports[shard['name']].get('error')
+                if error:
+                    shard_results.append((shard, None, error))
+                    continue
+
+                other_handles = [
+                    handle
+                    for other in sites[shard['site_code']] if other is not shard
+                    for handle in dspace_reports[other['name']].get('handles', [])
+                ]
+                result = pool.apply_async(
+                    run_shard, (shard, mode, redirects_cache, other_handles)
+                )
+                shard_results.append((shard, result, None))
+
+            reports = []
+            for shard, result, error in shard_results:
+                report = {'name': shard['name'], 'site_code': shard['site_code'],
+                          'dspace': dspace_reports[shard['name']].get('dspace', 0)}
+                report.update(result.get() if result is not None else {'error': error})
+                reports.append(report)
+        redirects_j = redirects_cache.copy()
+
+    with open(redirects, 'w') as f:
+        json.dump(redirects_j, f, indent=4)
+
+    merged = merge_reports(reports, site_reports)
+    with open(pjoin(shard_dir, 'shard_report.json'), 'w') as f:
+        json.dump(merged, f, indent=4)
+
+    for r in reports:
+        status = f"✗ {r['error']}" if 'error' in r else '✔'
+        print(f"\t{status} {r['name']}: {r.get('unposted', 0)} unposted of "
+              f"{r.get('dspace', 0)} DSpace records")
+    print(f"{merged['unposted']} unposted records across {len(reports)} shards.")
+    if merged['failed']:
+        print(f"Some shards failed: {', '.join(merged['failed'])}. "
+              f"See {pjoin(shard_dir, 'shard_report.json')}")
+    return merged
+
+
+if __name__ == '__main__':
+    args = sys.argv
+
+    help_s = """
+Usage: python run_shards.py CONFIG [OPTION]
+
+CONFIG is a JSON list of shards, see examples/shards.example.json.
+Without an option, only scrape and generate each shard's entry form.
+Otherwise, also post each shard with one of the following options:
+    --dry-run: Make fake requests locally to test workflow.
+    --test: Post to OSTI's test server.
+    --prod: Post to OSTI's prod server.
+Shards whose form input gained unreviewed rows are not posted to test/prod.
+    """
+
+    commands = ['--dry-run', '--test', '--prod']
+
+    if len(args) not in [2, 3] or args[1] in ['--help', '-h'] or \
+            (len(args) == 3 and args[2] not in commands):
+        print(help_s)
+    else:
+        mode = args[2][2:] if len(args) == 3 else None
+        user_response = 'yes'
+        if mode in ['test', 'prod']:
+            print(f"WARNING: Running this script in {mode} mode will "
+                  "trigger emails to every shard's group and OSTI!")
+            user_response = input(
+                "Are you sure you wish you proceed? (Enter 'Yes'/'yes') "
+            )
+            print(f"User response: {user_response}")
+        if user_response.lower() == 'yes':
+            run_shards(args[1], mode=mode)
+        else:
+            print("Exiting!!! You must respond with a Yes/yes")